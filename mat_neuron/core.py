@@ -5,6 +5,7 @@ This module provides functions for integrating the MAT model
 """
 from __future__ import division, print_function, absolute_import
 
+from mat_neuron import _model
 # import random_seed function so user can set seed
 from mat_neuron._model import random_seed, impulse_matrix
 
@@ -25,7 +26,6 @@ def predict(current, params, dt, upsample=1, stochastic=False):
     ddθV) and an (N*upsample,) array of spikes
 
     """
-    from mat_neuron import _model
     state = _model.voltage(current, params, dt, upsample=upsample)
     Vx = state[:, 0] - state[:, 2] - params[3]
     if not stochastic:
@@ -40,11 +40,10 @@ def predict(current, params, dt, upsample=1, stochastic=False):
 
 def log_likelihood(spikes, current, params, dt, upsample=1):
     """Calculate log-likelihood of spikes conditional on current and parameters"""
-    from mat_neuron._model import voltage, adaptation, log_likelihood_poisson
-    state = voltage(current, params, dt, upsample=upsample)
-    adapt = adaptation(spikes, params[6:8], dt)
+    state = _model.voltage(current, params, dt, upsample=upsample)
+    adapt = _model.adaptation(spikes, params[6:8], dt)
     Vx = state[:, 0] - state[:, 2] - params[3]
-    return log_likelihood_poisson(Vx, adapt, spikes, params[:2], dt, upsample)
+    return _model.log_likelihood_poisson(Vx, adapt, spikes, params[:2], dt, upsample)
 
 
 def voltage(current, params, dt, **kwargs):
@@ -60,7 +59,6 @@ def voltage(current, params, dt, **kwargs):
     Returns an Nx3 array of the model state variables (V, θV, ddθV)
 
     """
-    from mat_neuron import _model
     return _model.voltage(current, params, dt, **kwargs)
 
 
@@ -74,7 +72,6 @@ def adaptation(spikes, taus, dt):
     Returns (nbins, ntaus) array
 
     """
-    from mat_neuron import _model
     return _model.adaptation(spikes, taus, dt)
 
 
@@ -86,7 +83,6 @@ def log_intensity(V, H, params):
     params: list of parameters (see predict() for specification)
 
     """
-    from mat_neuron import _model
     return _model.log_intensity(V, H, params)
 
 
@@ -132,13 +132,13 @@ setup(
     classifiers=[x for x in cls_txt.split("\n") if x],
     install_requires=[
         "numpy>=1.10",
+        "scipy>=0.19",
     ],
     build_requires=[
         "pybind11>=2.2",
     ],
-    tests_require=['nose', 'scipy'],
+    tests_require=['pytest', 'scipy', 'numba'],
 
     author="Tyler Robbins",
     maintainer='C Daniel Meliza',
-    test_suite='nose.collector',
 )
@@ -1,13 +1,35 @@
 # -*- coding: utf-8 -*-
 # -*- mode: python -*-
 
-from nose.tools import assert_equal, assert_true, assert_almost_equal, assert_sequence_equal
+import pytest
 import numpy as np
 
 from mat_neuron import core
 dt = 1.0
 
 
+@pytest.fixture(scope="module")
+def step_current():
+    I = np.zeros(1000, dtype='d')
+    I[200:] = 0.55
+    return I
+
+
+@pytest.fixture(scope="module")
+def step_response(step_current):
+    params = [10, 2, 0, 5, 10, 10, 10, 200, 5, 2]
+    return params, core.predict(step_current, params, dt)
+
+
+@pytest.fixture(scope="module")
+def likelihood_data():
+    I = np.zeros(2000, dtype='d')
+    I[500:1500] = 0.55
+    params_true = np.asarray([10, 2, 0, 5, 10, 10, 10, 200, 5, 2])
+    Y_true, spk_v = core.predict(I, params_true, dt)
+    return I, params_true, Y_true, spk_v
+
+
 def test_impulse_matrix():
     """Impulse matrix should have the correct dimension and diagonal values"""
     from mat_neuron._pymodel import impulse_matrix as imp_ref
@@ -15,34 +37,176 @@ def test_impulse_matrix():
     params = [10, 2, 0.1, 5, 10, 10, 11, 200, 5, 2]
     Aexp_ref = imp_ref(params, dt, reduced=True)
     Aexp = impulse_matrix(params, dt)
-    assert_equal(Aexp.shape, (4, 4))
-    assert_true(np.all(np.abs(Aexp - Aexp_ref) < 1e-6))
+    assert Aexp.shape == (4, 4)
+    assert np.all(np.abs(Aexp - Aexp_ref) < 1e-6)
+
+
+# includes the degenerate case where tm == tv, tv just outside the Taylor range
+# on either side of tm, and a large dt / tv
+@pytest.mark.parametrize("params", [[10, 2, 0.1, 5, 10, 10, 11, 200, 5, 2],
+                                    [10, 2, -0.3, 5, 10, 10, 11, 200, 10, 2],
+                                    [10, 2, 1, 5, 10, 10, 11, 200, 9.9, 2],
+                                    [10, 2, 1, 5, 10, 10, 11, 200, 10.1, 2],
+                                    [10, 2, 0.1, 5, 10, 10, 11, 200, 0.001, 2]])
+@pytest.mark.parametrize("reduced", [False, True])
+def test_impulse_matrix_closed_form(params, reduced):
+    """Closed-form impulse matrix should match the numerical matrix exponential"""
+    from scipy import linalg
+    from mat_neuron._pymodel import impulse_matrix, system_matrix
+    Aexp = impulse_matrix(params, dt, reduced=reduced)
+    Aexp_ref = linalg.expm(system_matrix(params, reduced) * dt)
+    assert np.all(np.abs(Aexp - Aexp_ref) < 1e-12)
+
+
+def test_impulse_matrix_cache():
+    """Cached impulse matrix should be reused when only alphas, omega or tref change"""
+    from mat_neuron._pymodel import predict_voltage, _impulse_matrix_cached
+    I = np.random.randn(100)
+    predict_voltage(np.zeros(6), [10, 2, 0.1, 5, 10, 10, 11, 200, 5, 2], I, dt)
+    hits = _impulse_matrix_cached.cache_info().hits
+    predict_voltage(np.zeros(6), [-50, -5, 0.1, 0, 10, 10, 11, 200, 5, 4], I, dt)
+    assert _impulse_matrix_cached.cache_info().hits == hits + 1
+
+
+def test_reference_voltage(step_current):
+    """Python reference integration of voltage should match the compiled version"""
+    from mat_neuron._pymodel import predict_voltage, impulse_matrix
+    params = [10, 2, 0.1, 5, 10, 10, 11, 200, 5, 2]
+    I = step_current
+    Y_ref = predict_voltage(np.zeros(6), params, I, dt)
+    Y = core.voltage(I, params, dt)
+    assert Y_ref.shape == Y.shape
+    assert np.all(np.abs(Y - Y_ref) < 1e-6)
+    # the voltage block of the full impulse matrix can be supplied
+    Y_shared = predict_voltage(np.zeros(6), params, I, dt, Aexp=impulse_matrix(params, dt))
+    assert np.all(np.abs(Y_shared - Y_ref) < 1e-12)
+    for shape in ((3, 3), (5, 5)):
+        with pytest.raises(ValueError):
+            predict_voltage(np.zeros(6), params, I, dt, Aexp=np.eye(*shape))
+    Y_single = predict_voltage(np.zeros(6), params, I, dt, dtype='f')
+    assert Y_single.dtype == np.float32
+    assert np.all(np.abs(Y - Y_single) < 1e-4)
+    # error accumulates with the number of steps
+    I_long = np.random.RandomState(0).randn(200000)
+    V_double = predict_voltage(np.zeros(6), params, I_long, dt)[:, 0]
+    V_single = predict_voltage(np.zeros(6), params, I_long, dt, dtype='f')[:, 0]
+    assert np.max(np.abs(V_single - V_double)) < 1e-4 * np.max(np.abs(V_double))
+
+
+def test_reference_steady_state(step_current):
+    """Steady-state solution should match the end of a long step response"""
+    from mat_neuron._pymodel import predict_voltage, predict_voltage_steady_state
+    # R and tm differ so that swapping them would be caught
+    params = [10, 2, -0.3, 5, 20, 10, 11, 200, 5, 2]
+    I = step_current
+    Y = predict_voltage(np.zeros(6), params, I, dt)
+    y_ss = predict_voltage_steady_state(params, I[-1])
+    assert y_ss[0] == pytest.approx(I[-1] * params[4], abs=1e-7)
+    assert y_ss[1] == pytest.approx(I[-1] * params[4] / params[5], abs=1e-7)
+    assert np.all(np.abs(Y[-1] - y_ss) < 1e-9)
+
+
+def test_reference_voltage_batch():
+    """Batched voltage integration should match integrating each trial"""
+    from mat_neuron._pymodel import predict_voltage, predict_voltage_batch
+    params = [10, 2, 0.1, 5, 10, 10, 11, 200, 5, 2]
+    I = np.random.randn(5, 500)
+    Y = predict_voltage_batch(np.zeros(6), params, I, dt)
+    assert Y.shape == (5, 500, 4)
+    for i in range(I.shape[0]):
+        assert np.all(np.abs(Y[i] - predict_voltage(np.zeros(6), params, I[i], dt)) < 1e-9)
+
+
+def test_reference_voltage_blocked():
+    """Block-propagated voltage integration should match the step-by-step version"""
+    from mat_neuron._pymodel import impulse_matrix, _predict_voltage_core, _predict_voltage_blocked
+    params = [10, 2, 0.1, 5, 10, 10, 11, 200, 5, 2]
+    Aexp = impulse_matrix(params, dt, reduced=True)
+    forcing = np.random.randn(1001)
+    y = np.asarray([0.1, 0.2, 0.3, 0.4])
+    Y_ref = _predict_voltage_core(Aexp, forcing, y)
+    Y = _predict_voltage_blocked(Aexp, forcing, y)
+    assert Y.shape == Y_ref.shape
+    assert np.all(np.abs(Y - Y_ref) < 1e-9)
 
 
-def test_step_response():
+def test_reference_adaptation():
+    """Python reference adaptation should match the compiled version"""
+    from mat_neuron._pymodel import predict_adaptation
+    params = np.asarray([10, 2, 0, 5, 10, 10, 10, 200, 5, 2])
+    spk = np.zeros(1000, dtype='i')
+    spk[[100, 250, 251, 600]] = 1
+    H_ref = predict_adaptation(params, np.zeros(6), spk.nonzero()[0] * dt, dt, spk.size)
+    # the compiled version is causal and not scaled by the alphas
+    H = core.adaptation(spk, params[6:8], dt) + spk[:, np.newaxis]
+    assert np.all(np.abs(H * params[:2] - H_ref) < 1e-9)
+    # boolean spike arrays are used directly
+    H_spk = predict_adaptation(params, np.zeros(6), spk.astype(bool), dt, spk.size)
+    assert np.all(np.abs(H_spk - H_ref) < 1e-9)
+    # integer spike times are times, even when there are N of them
+    times = np.arange(5)
+    H_int = predict_adaptation(params, np.zeros(6), times, dt, times.size)
+    H_float = predict_adaptation(params, np.zeros(6), times * dt, dt, times.size)
+    assert np.all(np.abs(H_int - H_float) < 1e-9)
+
+
+@pytest.mark.parametrize("numba", [True, False])
+def test_reference_likelihood(likelihood_data, numba, monkeypatch):
+    """Fused log-likelihood should match the sum over the log intensity"""
+    from mat_neuron import _pymodel
+    if not numba:
+        # exercise the vectorized fallback used when numba is not installed
+        monkeypatch.setattr(_pymodel, "_has_numba", False)
+    I, params, _, _ = likelihood_data
+    spk = np.zeros(I.size, dtype='i')
+    spk[[600, 800, 1200]] = 1
+    V = _pymodel.predict_voltage(np.zeros(6), params, I, dt)
+    H = _pymodel.predict_adaptation(params, np.zeros(6), spk.nonzero()[0] * dt, dt, I.size)
+    mu = _pymodel.log_intensity(V, H, params)
+    assert np.all(np.abs(mu - (V[:, 0] - V[:, 2] - H.sum(1) - params[3])) < 1e-9)
+    ll = np.sum(mu[spk.nonzero()]) - dt * np.sum(np.exp(mu))
+    assert _pymodel.log_likelihood(V, H, spk, params, dt) == pytest.approx(ll, abs=1e-7)
+
+
+@pytest.mark.parametrize("V_cols, H_cols, H_rows, spk_len", [(2, 2, 5, 5),
+                                                             (3, 1, 5, 5),
+                                                             (3, 2, 4, 5),
+                                                             (3, 2, 5, 4)])
+def test_reference_likelihood_shapes(V_cols, H_cols, H_rows, spk_len):
+    """Log intensity and likelihood should reject arrays with the wrong shape"""
+    from mat_neuron import _pymodel
     params = [10, 2, 0, 5, 10, 10, 10, 200, 5, 2]
-    I = np.zeros(1000, dtype='d')
-    I[200:] = 0.55
-    Y, S = core.predict(I, params, dt)
+    V = np.zeros((5, V_cols))
+    H = np.zeros((H_rows, H_cols))
+    spk = np.zeros(spk_len, dtype='i')
+    with pytest.raises(ValueError):
+        _pymodel.log_likelihood(V, H, spk, params, dt)
+    if spk_len == 5:
+        with pytest.raises(ValueError):
+            _pymodel.log_intensity(V, H, params)
+
+
+def test_step_response(step_current, step_response):
+    I = step_current
+    params, (Y, S) = step_response
     spk = S.nonzero()[0]
 
-    assert_almost_equal(Y[-1, 1], I[-1], msg="incorrect current integration")
-    assert_almost_equal(Y[-1, 0], I[-1] * params[5], msg="incorrect steady-state voltage")
+    assert Y[-1, 1] == pytest.approx(I[-1], abs=1e-7), "incorrect current integration"
+    assert Y[-1, 0] == pytest.approx(I[-1] * params[5], abs=1e-7), "incorrect steady-state voltage"
     T = np.asarray([224, 502, 824])
-    assert_true(np.all(T == spk))
+    assert np.all(T == spk)
 
 
-def test_stimulus_upsample():
+def test_stimulus_upsample(step_current):
     params = [10, 2, 0, 5, 10, 10, 10, 200, 5, 2]
-    I = np.zeros(1000, dtype='d')
-    I[200:] = 0.55
+    I = step_current
     Y2, S2 = core.predict(I, params, dt, upsample=2)
     spk = S2.nonzero()[0]
 
-    assert_equal(S2.size, I.size * 2)
-    assert_equal(Y2[:,1].nonzero()[0][0], 400)
+    assert S2.size == I.size * 2
+    assert Y2[:, 1].nonzero()[0][0] == 400
     T = np.asarray([224, 502, 824])
-    assert_true(np.all(T + 200 == spk[:3]))
+    assert np.all(T + 200 == spk[:3])
 
 
 def test_phasic_response():
@@ -51,39 +215,25 @@ def test_phasic_response():
     I[200:] = 0.5
     Y, S = core.predict(I, params, dt)
     spk = S.nonzero()[0]
-    assert_almost_equal(Y[-1, 0], I[-1] * params[5], msg="incorrect steady-state voltage")
-    assert_equal(len(spk), 1)
-    assert_true(spk[0] == 212)
-
-
-def test_poisson_spiker():
-    params = [10, 2, 0, 5, 10, 10, 10, 200, 5, 2]
-    I = np.zeros(2000, dtype='d')
-    I[500:1500] = 0.5
-    core.random_seed(1)
-    Y, S1 = core.predict(I, params, dt, stochastic=True)
-    core.random_seed(1)
-    Y, S2 = core.predict(I, params, dt, stochastic=True)
-    assert_true(np.all(S1 == S2))
+    assert Y[-1, 0] == pytest.approx(I[-1] * params[5], abs=1e-7), "incorrect steady-state voltage"
+    assert len(spk) == 1
+    assert spk[0] == 212
 
 
-def test_softplus_spiker():
+@pytest.mark.parametrize("stochastic", [True, "softplus"])
+def test_stochastic_spiker(stochastic):
     params = [10, 2, 0, 5, 10, 10, 10, 200, 5, 2]
     I = np.zeros(2000, dtype='d')
     I[500:1500] = 0.5
     core.random_seed(1)
-    Y, S1 = core.predict(I, params, dt, stochastic="softplus")
+    Y, S1 = core.predict(I, params, dt, stochastic=stochastic)
     core.random_seed(1)
-    Y, S2 = core.predict(I, params, dt, stochastic="softplus")
-    assert_true(np.all(S1 == S2))
+    Y, S2 = core.predict(I, params, dt, stochastic=stochastic)
+    assert np.all(S1 == S2)
 
 
-def test_likelihood():
-    I = np.zeros(2000, dtype='d')
-    I[500:1500] = 0.55
-
-    params_true = np.asarray([10, 2, 0, 5, 10, 10, 10, 200, 5, 2])
-    Y_true, spk_v = core.predict(I, params_true, dt)
+def test_likelihood(likelihood_data):
+    I, params_true, Y_true, spk_v = likelihood_data
     S_obs = spk_v.nonzero()[0]
 
     llf = core.log_likelihood(spk_v, I, params_true, dt)
@@ -92,22 +242,18 @@ def test_likelihood():
     H = core.adaptation(spk_v, params_true[6:8], dt)
     mu = V[:, 0] - V[:, 2] - np.dot(H, params_true[:2]) - params_true[3]
     ll = np.sum(mu[S_obs]) - dt * np.sum(np.exp(mu))
-    assert_almost_equal(llf, ll)
+    assert llf == pytest.approx(ll, abs=1e-7)
 
     params_guess = np.asarray([-50, -5, -5, 0, 10, 10, 10, 200, 5, 2])
     llf_g = core.log_likelihood(spk_v, I, params_guess, dt)
-    assert_true(llf > llf_g)
+    assert llf > llf_g
 
 
-def test_likelihood_upsample():
+def test_likelihood_upsample(likelihood_data):
     # resampling does change the log-likelihood so this function just tests that
     # the upsampling works correctly
     from mat_neuron._model import log_likelihood_poisson
-    I = np.zeros(2000, dtype='d')
-    I[500:1500] = 0.55
-
-    params_true = np.asarray([10, 2, 0, 5, 10, 10, 10, 200, 5, 2])
-    Y_true, spk_v = core.predict(I, params_true, dt)
+    I, params_true, Y_true, spk_v = likelihood_data
     V = Y_true[:, 0]
     H = core.adaptation(spk_v, params_true[6:8], dt)
     ll = log_likelihood_poisson(V, H, spk_v, params_true[:2], dt)
@@ -131,4 +277,4 @@ def test_likelihood_nomembrane():
     interp = sps.kron(sps.eye(nframes), np.ones((upsample, 1),), format='csc')
     mu = interp.dot(V) - np.dot(adapt, (a1, a2)) - omega
     ll = np.sum(mu[spike_t]) - dt * np.sum(np.exp(mu))
-    assert_almost_equal(llf, ll)
+    assert llf == pytest.approx(ll, abs=1e-7)